@@ -6,17 +6,23 @@ Reads Chrome and Safari browser history and generates daily markdown digests.
 """
 from __future__ import annotations
 
+import heapq
 import json
 import os
 import re
 import shutil
 import sqlite3
 import subprocess
+import sys
 import tempfile
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timedelta
+from itertools import groupby
+from operator import attrgetter
 from pathlib import Path
-from typing import Optional
-from urllib.parse import parse_qs, urlencode, urlparse, urlunparse
+from typing import NamedTuple
 
 # Configuration
 OUTPUT_DIR = Path.home() / "memex" / "browser"
@@ -26,6 +32,16 @@ ERROR_LOG = OUTPUT_DIR / ".errors.log"
 STATUS_FILE = OUTPUT_DIR / ".status"
 NOTIFIED_ERRORS_FILE = OUTPUT_DIR / ".notified_errors"
 PERMISSION_ERROR_FILE = OUTPUT_DIR / "PERMISSION_ERROR.txt"
+WRITTEN_DAYS_FILE = OUTPUT_DIR / ".written_days"
+INDEX_DB = OUTPUT_DIR / ".index.db"
+
+# Command line patterns of processes that may have each browser's history open
+CHROME_PROCESS_PATTERN = "Google Chrome"
+SAFARI_PROCESS_PATTERN = "Safari"
+
+# Visits this recent are read again on each run, since browsers may fill in
+# a page's title after recording the visit
+RECENT_VISIT_LOOKBACK = timedelta(hours=1)
 
 # URL prefixes to exclude (noise for AI context)
 EXCLUDED_PREFIXES = (
@@ -40,7 +56,7 @@ EXCLUDED_PREFIXES = (
 )
 
 # Tracking parameters to strip from URLs
-TRACKING_PARAMS = {
+TRACKING_PARAMS = frozenset({
     "utm_source", "utm_medium", "utm_campaign", "utm_term", "utm_content",
     "utm_id", "utm_source_platform", "utm_creative_format", "utm_marketing_tactic",
     "fbclid", "gclid", "gclsrc", "dclid", "gbraid", "wbraid",
@@ -52,7 +68,38 @@ TRACKING_PARAMS = {
     "_ga", "_gl", "_hsenc", "_hsmi", "_ke",
     "trk", "trkInfo", "originalReferer",
     "algo", "algo_expid", "btsid", "ws_ab_test", "spm", "pvid", "scm",
-}
+})
+
+# Tracking parameter name prefixes, so every utm_* variant is stripped
+TRACKING_PARAM_PREFIXES = ("utm_",)
+
+# Matches one "&name" or "&name=value" query segment for any tracking parameter.
+# Bare names are matched too, as parse_qs(keep_blank_values=True) would.
+# Prefixed names collapse into a single branch, keeping the alternation short.
+TRACKING_PARAM_RE = re.compile(
+    r"&(?:"
+    + "|".join(
+        [re.escape(prefix) + r"[^=&]*" for prefix in TRACKING_PARAM_PREFIXES]
+        + [
+            re.escape(param) for param in sorted(TRACKING_PARAMS)
+            if not param.startswith(TRACKING_PARAM_PREFIXES)
+        ]
+    )
+    + r")(?:=[^&]*)?(?=&|$)",
+    re.IGNORECASE,
+)
+
+# Connection settings for reading history databases: read-only, memory-mapped
+# pages, a 64MB page cache and in-memory temp storage for sorting
+HISTORY_DB_PRAGMAS = """
+    PRAGMA query_only=ON;
+    PRAGMA mmap_size=268435456;
+    PRAGMA cache_size=-65536;
+    PRAGMA temp_store=MEMORY;
+"""
+
+# Characters escaped in page titles so they can't break markdown links
+MARKDOWN_ESCAPES = str.maketrans({"[": "\\[", "]": "\\]", "|": "\\|"})
 
 # WebKit timestamp epoch (Jan 1, 1601) to Unix epoch offset
 WEBKIT_EPOCH_OFFSET = 11644473600
@@ -61,9 +108,19 @@ WEBKIT_EPOCH_OFFSET = 11644473600
 MAC_ABSOLUTE_TIME_OFFSET = 978307200
 
 
+class Entry(NamedTuple):
+    """A single history visit."""
+    url: str
+    title: str
+    timestamp: float  # Unix timestamp, used for ordering
+    day: date  # Local date of the visit
+    time: str  # Local "HH:MM" time of the visit
+    profile: str
+    domain: str  # Interned, since a few domains account for most visits
+
+
 def log_error(message: str) -> None:
     """Append error message to error log."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     with open(ERROR_LOG, "a") as f:
         f.write(f"[{timestamp}] {message}\n")
@@ -71,7 +128,6 @@ def log_error(message: str) -> None:
 
 def write_status(status: dict) -> None:
     """Write JSON status file showing health of each data source."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     status["last_run"] = datetime.now().isoformat()
     with open(STATUS_FILE, "w") as f:
         json.dump(status, f, indent=2)
@@ -87,20 +143,10 @@ def get_notified_errors() -> set[str]:
         return set()
 
 
-def add_notified_error(error_key: str) -> None:
-    """Record that we've notified about this error."""
-    notified = get_notified_errors()
-    notified.add(error_key)
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
-    NOTIFIED_ERRORS_FILE.write_text("\n".join(notified))
-
-
-def clear_notified_error(error_key: str) -> None:
-    """Clear a notified error when it's resolved."""
-    notified = get_notified_errors()
-    notified.discard(error_key)
+def set_notified_errors(notified: set[str]) -> None:
+    """Record the error keys we've notified about."""
     if notified:
-        NOTIFIED_ERRORS_FILE.write_text("\n".join(notified))
+        NOTIFIED_ERRORS_FILE.write_text("\n".join(sorted(notified)))
     elif NOTIFIED_ERRORS_FILE.exists():
         NOTIFIED_ERRORS_FILE.unlink()
 
@@ -120,7 +166,6 @@ def send_notification(title: str, message: str) -> None:
 
 def write_error_indicator(errors: list[str]) -> None:
     """Create a visible error file explaining permission issues."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
     content = """MEMEX BROWSER CAPTURE - PERMISSION ERROR
 
 One or more browser history sources cannot be accessed due to macOS permissions.
@@ -147,124 +192,319 @@ def remove_error_indicator() -> None:
         PERMISSION_ERROR_FILE.unlink()
 
 
-def webkit_to_datetime(webkit_timestamp: int) -> datetime:
-    """Convert WebKit timestamp (microseconds since 1601) to datetime."""
-    unix_timestamp = (webkit_timestamp / 1_000_000) - WEBKIT_EPOCH_OFFSET
-    return datetime.fromtimestamp(unix_timestamp)
+# Caches for local_day_and_time, keyed by quarter-hour and by local day number
+_utc_offsets: dict[int, int] = {}
+_days: dict[int, date] = {}
+
+# "HH:MM" strings for every minute of the day, shared by all visits
+_minute_strings = [f"{minute // 60:02d}:{minute % 60:02d}" for minute in range(1440)]
+
+
+def local_day_and_time(unix_timestamp: float) -> tuple[date, str]:
+    """Convert Unix timestamp to its local date and "HH:MM" time.
+
+    Avoids building a datetime per visit. Time zone offsets rarely change, so
+    the offset is looked up once per quarter-hour and cached when it is the
+    same at both ends of it. Quarter-hours containing a transition (which is
+    not always on a quarter-hour boundary) look up the offset per visit.
+    Date objects and time strings are shared by all visits with the same value.
+    """
+    seconds = int(unix_timestamp // 1)
+    quarter_hour = seconds // 900
+    offset = _utc_offsets.get(quarter_hour)
+    if offset is None:
+        offset = time.localtime(quarter_hour * 900).tm_gmtoff
+        if time.localtime(quarter_hour * 900 + 899).tm_gmtoff == offset:
+            _utc_offsets[quarter_hour] = offset
+        else:
+            offset = time.localtime(seconds).tm_gmtoff
+
+    local_seconds = seconds + offset
+    day_number = local_seconds // 86400
+    day = _days.get(day_number)
+    if day is None:
+        day = _days[day_number] = date(1970, 1, 1) + timedelta(days=day_number)
+
+    return day, _minute_strings[local_seconds % 86400 // 60]
+
 
+def datetime_to_webkit(dt: datetime) -> int:
+    """Convert datetime to WebKit timestamp (microseconds since 1601)."""
+    return int((dt.timestamp() + WEBKIT_EPOCH_OFFSET) * 1_000_000)
 
-def mac_absolute_to_datetime(mac_timestamp: float) -> datetime:
-    """Convert Mac Absolute Time (seconds since 2001) to datetime."""
-    unix_timestamp = mac_timestamp + MAC_ABSOLUTE_TIME_OFFSET
-    return datetime.fromtimestamp(unix_timestamp)
+
+def datetime_to_mac_absolute(dt: datetime) -> float:
+    """Convert datetime to Mac Absolute Time (seconds since 2001)."""
+    return dt.timestamp() - MAC_ABSOLUTE_TIME_OFFSET
+
+
+# Cleaned URLs by raw URL, since history revisits the same pages many times
+_clean_urls: dict[str, str] = {}
 
 
 def clean_url(url: str) -> str:
-    """Remove tracking parameters from URL."""
-    try:
-        parsed = urlparse(url)
-        if not parsed.query:
-            return url
-
-        params = parse_qs(parsed.query, keep_blank_values=True)
-        cleaned_params = {
-            k: v for k, v in params.items()
-            if k.lower() not in TRACKING_PARAMS
-        }
-
-        cleaned_query = urlencode(cleaned_params, doseq=True)
-        cleaned = urlunparse((
-            parsed.scheme,
-            parsed.netloc,
-            parsed.path,
-            parsed.params,
-            cleaned_query,
-            ""  # Remove fragment too
-        ))
-        return cleaned.rstrip("?")
-    except Exception:
+    """Remove tracking parameters (and the fragment) from URL."""
+    cleaned = _clean_urls.get(url)
+    if cleaned is None:
+        cleaned = _clean_urls[url] = clean_url_uncached(url)
+    return cleaned
+
+
+def clean_url_uncached(url: str) -> str:
+    """Remove tracking parameters (and the fragment) from URL, without caching."""
+    if "?" not in url:
         return url
 
+    # Remove fragment too
+    without_fragment = url.partition("#")[0]
+    base, sep, query = without_fragment.partition("?")
+    if not sep:
+        return url
+
+    # Prefix with "&" so the first parameter matches like the rest
+    query = "&" + query
+    if not TRACKING_PARAM_RE.search(query):
+        return without_fragment
+
+    query = TRACKING_PARAM_RE.sub("", query)[1:]
+    return f"{base}?{query}" if query else base
+
+
+# Escaped titles by raw title, since revisited pages repeat their titles
+_escaped_titles: dict[str, str] = {}
+
 
 def escape_markdown(text: str) -> str:
     """Escape text for safe use in markdown links."""
+    escaped = _escaped_titles.get(text)
+    if escaped is None:
+        escaped = _escaped_titles[text] = escape_markdown_uncached(text)
+    return escaped
+
+
+def escape_markdown_uncached(text: str) -> str:
+    """Escape text for safe use in markdown links, without caching."""
     if not text:
         return "Untitled"
     # Remove newlines and excessive whitespace
     text = " ".join(text.split())
     # Escape brackets and pipes
-    text = text.replace("[", "\\[").replace("]", "\\]")
-    text = text.replace("|", "\\|")
-    return text
+    return text.translate(MARKDOWN_ESCAPES)
+
+
+def excluded_url_sql(column: str) -> str:
+    """Build a SQL condition rejecting URLs in column that match EXCLUDED_PREFIXES."""
+    excluded = " AND ".join(f"{column} NOT GLOB '{prefix}*'" for prefix in EXCLUDED_PREFIXES)
+    # No excluded prefix starts with "http", so web URLs (nearly every row)
+    # pass on a single comparison instead of one per prefix
+    return f"({column} GLOB 'http*' OR ({excluded}))"
+
+
+def is_process_running(pattern: str) -> bool:
+    """Check whether any process command line matches pattern."""
+    try:
+        result = subprocess.run(["pgrep", "-f", pattern], capture_output=True, timeout=5)
+    except Exception:
+        return True  # Assume running, which only rules out the immutable open
+    # pgrep exits with 1 when nothing matches and above 1 on errors
+    return result.returncode != 1
+
+
+def open_history_db(path: Path, browser_running: bool = True) -> tuple[sqlite3.Connection, str | None]:
+    """Open a browser history database read-only.
+
+    Tries, in order:
+    1. In place as immutable, which skips locking entirely. Immutable mode
+       assumes nothing changes the file, so it is only used when the browser
+       isn't running and there is no write-ahead log or non-empty rollback
+       journal, which immutable mode would ignore.
+    2. In place with normal locking, inside a read transaction so the
+       history query sees a consistent snapshot including the log. Skipped
+       when the browser is running without a write-ahead log: it then holds
+       its own lock for as long as it runs (Chrome), and our read lock would
+       block its commits. A lock held by anything else fails immediately
+       rather than being waited out.
+    3. A temporary copy of the database and its log, for when the browser
+       keeps the database locked.
+
+    Returns:
+        Tuple of (connection, temporary directory to remove when done or None)
+    """
+    wal_path = Path(f"{path}-wal")
+    journal_path = Path(f"{path}-journal")
+    journal_empty = not journal_path.exists() or journal_path.stat().st_size == 0
+    has_wal = wal_path.exists()
+    if not browser_running and not has_wal and journal_empty:
+        conn = None
+        try:
+            conn = sqlite3.connect(
+                f"{path.as_uri()}?mode=ro&immutable=1", uri=True, isolation_level=None
+            )
+            conn.executescript(HISTORY_DB_PRAGMAS)
+            # Opening is lazy, so read the schema to surface errors here
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+            return conn, None
+        except sqlite3.Error:
+            if conn:
+                conn.close()
+
+    # SQLite reports unreadable files as a generic error, so open the file
+    # directly first to raise PermissionError for missing Full Disk Access
+    with open(path, "rb"):
+        pass
+
+    if has_wal or not browser_running:
+        conn = sqlite3.connect(
+            f"{path.as_uri()}?mode=ro", uri=True, timeout=0, isolation_level=None
+        )
+        try:
+            conn.executescript(HISTORY_DB_PRAGMAS)
+            conn.execute("BEGIN")
+            conn.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+            return conn, None
+        except sqlite3.OperationalError:
+            conn.close()
+
+    # Copy database to avoid lock issues
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        tmp_path = Path(tmp_dir) / path.name
+        shutil.copyfile(path, tmp_path)
+        if has_wal:
+            shutil.copyfile(wal_path, f"{tmp_path}-wal")
+        conn = sqlite3.connect(tmp_path, isolation_level=None)
+        conn.executescript(HISTORY_DB_PRAGMAS)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return conn, tmp_dir
 
 
 def get_chrome_profiles() -> list[Path]:
     """Find all Chrome profile directories containing a History file."""
-    if not CHROME_BASE.exists():
+    try:
+        items = os.scandir(CHROME_BASE)
+    except FileNotFoundError:
         return []
 
+    # scandir entries know their own file type, saving a stat per item
     profiles = []
-    for item in CHROME_BASE.iterdir():
-        if item.is_dir():
-            history_file = item / "History"
-            if history_file.exists():
-                profiles.append(item)
+    with items:
+        for item in items:
+            if item.is_dir() and os.path.exists(os.path.join(item.path, "History")):
+                profiles.append(Path(item.path))
     return profiles
 
 
-def read_history_from_profile(profile_path: Path, since: datetime | None = None) -> tuple[list[dict], str | None]:
+# History queries are built once so every call reuses the same SQL text.
+# The *_AFTER_QUERY variants read only visits inserted after a row id, plus
+# visits newer than a raw visit_time. Visits can be inserted out of
+# visit_time order (Safari syncs iOS visits in later), so the row id is what
+# marks where the previous run stopped. The ids are collected in a UNION ALL
+# subquery so each side uses its own index instead of scanning every visit.
+# Each row also carries the visit time converted to a Unix timestamp, so the
+# arithmetic runs in SQLite rather than per row in Python.
+# Chrome marks URLs it keeps out of its own history page (such as subframe
+# navigations) as hidden, so those are skipped too.
+CHROME_LAST_VISIT_ID_QUERY = "SELECT MAX(id) FROM visits"
+CHROME_HISTORY_QUERY = f"""
+    SELECT urls.url, urls.title,
+        visits.visit_time / 1000000.0 - {WEBKIT_EPOCH_OFFSET}
+    FROM visits
+    JOIN urls ON visits.url = urls.id
+    WHERE urls.hidden = 0 AND {excluded_url_sql("urls.url")}
+    ORDER BY visits.visit_time ASC
+"""
+CHROME_HISTORY_AFTER_QUERY = f"""
+    SELECT urls.url, urls.title,
+        visits.visit_time / 1000000.0 - {WEBKIT_EPOCH_OFFSET}
+    FROM visits
+    JOIN urls ON visits.url = urls.id
+    WHERE visits.id IN (
+        SELECT id FROM visits WHERE id > ?
+        UNION ALL
+        SELECT id FROM visits WHERE visit_time > ?
+    ) AND urls.hidden = 0 AND {excluded_url_sql("urls.url")}
+    ORDER BY visits.visit_time ASC
+"""
+
+# Safari uses a different schema
+# Note: title is in history_visits, not history_items
+SAFARI_LAST_VISIT_ID_QUERY = "SELECT MAX(id) FROM history_visits"
+SAFARI_HISTORY_QUERY = f"""
+    SELECT history_items.url, history_visits.title,
+        history_visits.visit_time + {MAC_ABSOLUTE_TIME_OFFSET}
+    FROM history_visits
+    JOIN history_items ON history_visits.history_item = history_items.id
+    WHERE {excluded_url_sql("history_items.url")}
+    ORDER BY history_visits.visit_time ASC
+"""
+SAFARI_HISTORY_AFTER_QUERY = f"""
+    SELECT history_items.url, history_visits.title,
+        history_visits.visit_time + {MAC_ABSOLUTE_TIME_OFFSET}
+    FROM history_visits
+    JOIN history_items ON history_visits.history_item = history_items.id
+    WHERE history_visits.id IN (
+        SELECT id FROM history_visits WHERE id > ?
+        UNION ALL
+        SELECT id FROM history_visits WHERE visit_time > ?
+    ) AND {excluded_url_sql("history_items.url")}
+    ORDER BY history_visits.visit_time ASC
+"""
+
+
+def read_history_from_profile(
+    profile_path: Path,
+    after_id: int | None = None,
+    reread_after: int | None = None,
+    browser_running: bool = True,
+) -> tuple[list[Entry], int | None, str | None]:
     """Read history entries from a Chrome profile.
 
+    Args:
+        profile_path: Chrome profile directory
+        after_id: Only read visits with a row id greater than this, or all
+            visits if None
+        reread_after: With after_id, also read visits with a raw WebKit
+            visit_time greater than this
+        browser_running: Whether Chrome may have the database open
+
     Returns:
-        Tuple of (entries list, error message or None if successful)
+        Tuple of (entries list, newest visit row id or None,
+        error message or None if successful)
     """
     history_file = profile_path / "History"
     if not history_file.exists():
-        return [], None
+        return [], None, None
 
     entries = []
-    tmp_file = None
+    last_visit_id = None
+    tmp_dir = None
     error = None
 
     try:
-        # Copy database to avoid lock issues
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".db")
-        tmp_file.close()
-        shutil.copy2(history_file, tmp_file.name)
-
-        conn = sqlite3.connect(tmp_file.name)
-        cursor = conn.cursor()
-
-        # Build query
-        query = """
-            SELECT urls.url, urls.title, visits.visit_time
-            FROM visits
-            JOIN urls ON visits.url = urls.id
-        """
-        params = []
-
-        if since:
-            webkit_since = int((since.timestamp() + WEBKIT_EPOCH_OFFSET) * 1_000_000)
-            query += " WHERE visits.visit_time >= ?"
-            params.append(webkit_since)
+        conn, tmp_dir = open_history_db(history_file, browser_running)
 
-        query += " ORDER BY visits.visit_time ASC"
-
-        cursor.execute(query, params)
+        # Read in the same snapshot as the visits; later inserts get higher ids
+        last_visit_id = conn.execute(CHROME_LAST_VISIT_ID_QUERY).fetchone()[0]
+        if after_id is None:
+            rows = conn.execute(CHROME_HISTORY_QUERY)
+        else:
+            rows = conn.execute(CHROME_HISTORY_AFTER_QUERY, (after_id, reread_after))
 
-        for url, title, visit_time in cursor.fetchall():
+        for url, title, timestamp in rows:
             try:
-                # Skip excluded URLs (chrome://, extensions, etc.)
-                if url.startswith(EXCLUDED_PREFIXES):
-                    continue
-
-                dt = webkit_to_datetime(visit_time)
-                entries.append({
-                    "url": clean_url(url),
-                    "title": escape_markdown(title or ""),
-                    "timestamp": dt,
-                    "profile": profile_path.name
-                })
+                day, time_str = local_day_and_time(timestamp)
+                url = clean_url(url)
+                entries.append(Entry(
+                    url=url,
+                    title=title or "",
+                    timestamp=timestamp,
+                    day=day,
+                    time=time_str,
+                    profile=profile_path.name,
+                    domain=sys.intern(get_domain(url)),
+                ))
             except Exception as e:
                 log_error(f"Failed to process entry: {e}")
 
@@ -279,65 +519,61 @@ def read_history_from_profile(profile_path: Path, since: datetime | None = None)
         log_error(f"Failed to read history from {profile_path.name}: {e}")
 
     finally:
-        if tmp_file and os.path.exists(tmp_file.name):
-            os.unlink(tmp_file.name)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    return entries, error
+    return entries, last_visit_id, error
 
 
-def read_safari_history(since: datetime | None = None) -> tuple[list[dict], str | None]:
+def read_safari_history(
+    after_id: int | None = None,
+    reread_after: float | None = None,
+    browser_running: bool = True,
+) -> tuple[list[Entry], int | None, str | None]:
     """Read history entries from Safari.
 
+    Args:
+        after_id: Only read visits with a row id greater than this, or all
+            visits if None
+        reread_after: With after_id, also read visits with a raw Mac Absolute
+            visit_time greater than this
+        browser_running: Whether Safari may have the database open
+
     Returns:
-        Tuple of (entries list, error message or None if successful)
+        Tuple of (entries list, newest visit row id or None,
+        error message or None if successful)
     """
     if not SAFARI_HISTORY.exists():
-        return [], None
+        return [], None, None
 
     entries = []
-    tmp_file = None
+    last_visit_id = None
+    tmp_dir = None
     error = None
 
     try:
-        # Copy database to avoid lock issues
-        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".db")
-        tmp_file.close()
-        shutil.copy2(SAFARI_HISTORY, tmp_file.name)
-
-        conn = sqlite3.connect(tmp_file.name)
-        cursor = conn.cursor()
+        conn, tmp_dir = open_history_db(SAFARI_HISTORY, browser_running)
 
-        # Build query - Safari uses different schema
-        # Note: title is in history_visits, not history_items
-        query = """
-            SELECT history_items.url, history_visits.title, history_visits.visit_time
-            FROM history_visits
-            JOIN history_items ON history_visits.history_item = history_items.id
-        """
-        params = []
-
-        if since:
-            mac_since = since.timestamp() - MAC_ABSOLUTE_TIME_OFFSET
-            query += " WHERE history_visits.visit_time >= ?"
-            params.append(mac_since)
-
-        query += " ORDER BY history_visits.visit_time ASC"
-
-        cursor.execute(query, params)
+        # Read in the same snapshot as the visits; later inserts get higher ids
+        last_visit_id = conn.execute(SAFARI_LAST_VISIT_ID_QUERY).fetchone()[0]
+        if after_id is None:
+            rows = conn.execute(SAFARI_HISTORY_QUERY)
+        else:
+            rows = conn.execute(SAFARI_HISTORY_AFTER_QUERY, (after_id, reread_after))
 
-        for url, title, visit_time in cursor.fetchall():
+        for url, title, timestamp in rows:
             try:
-                # Skip excluded URLs
-                if url.startswith(EXCLUDED_PREFIXES):
-                    continue
-
-                dt = mac_absolute_to_datetime(visit_time)
-                entries.append({
-                    "url": clean_url(url),
-                    "title": escape_markdown(title or ""),
-                    "timestamp": dt,
-                    "profile": "Safari"
-                })
+                day, time_str = local_day_and_time(timestamp)
+                url = clean_url(url)
+                entries.append(Entry(
+                    url=url,
+                    title=title or "",
+                    timestamp=timestamp,
+                    day=day,
+                    time=time_str,
+                    profile="Safari",
+                    domain=sys.intern(get_domain(url)),
+                ))
             except Exception as e:
                 log_error(f"Failed to process Safari entry: {e}")
 
@@ -356,68 +592,60 @@ def read_safari_history(since: datetime | None = None) -> tuple[list[dict], str
         log_error(f"Failed to read Safari history: {e}")
 
     finally:
-        if tmp_file and os.path.exists(tmp_file.name):
-            os.unlink(tmp_file.name)
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
 
-    return entries, error
+    return entries, last_visit_id, error
 
 
 def get_domain(url: str) -> str:
     """Extract domain from URL."""
-    try:
-        parsed = urlparse(url)
-        return parsed.netloc or url
-    except Exception:
+    # Slice the netloc out directly instead of building a full urlparse result
+    scheme_end = url.find("://")
+    if scheme_end <= 0 or ":" in url[:scheme_end]:
         return url
 
+    start = scheme_end + 3
+    end = len(url)
+    for delimiter in "/?#":
+        i = url.find(delimiter, start, end)
+        if i != -1:
+            end = i
+    return url[start:end] or url
 
-def dedupe_entries(entries: list[dict]) -> list[dict]:
-    """Remove duplicate URLs, keeping the first occurrence."""
-    if not entries:
-        return entries
-
-    seen_urls = set()
-    result = []
-    for entry in entries:
-        if entry["url"] not in seen_urls:
-            seen_urls.add(entry["url"])
-            result.append(entry)
-    return result
 
+def generate_day_markdown(day: date, entries: list[Entry]) -> bytearray:
+    """Generate UTF-8 encoded markdown content for a day's history.
 
-def count_domains(entries: list[dict]) -> list[tuple[str, int]]:
-    """Count visits per domain, sorted by count descending."""
-    counts = {}
-    for entry in entries:
-        domain = get_domain(entry["url"])
-        counts[domain] = counts.get(domain, 0) + 1
-    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))
-
+    Args:
+        day: Date of the digest
+        entries: The day's entries, in timestamp order
+    """
+    day_name = day.strftime("%A, %B %d, %Y")
+    lines = [f"# Browser History: {day_name}", ""]
 
-def group_entries_by_day(entries: list[dict]) -> dict[date, list[dict]]:
-    """Group entries by date."""
-    days = {}
+    # Dedupe (keeping the first visit to each URL) and encode visit lines
+    # in a single pass
+    seen_urls = set()
+    visits = []
+    visit_lines = bytearray()
     for entry in entries:
-        day_key = entry["timestamp"].date()
-        if day_key not in days:
-            days[day_key] = []
-        days[day_key].append(entry)
-    return days
-
+        if entry.url in seen_urls:
+            continue
+        seen_urls.add(entry.url)
+        visits.append(entry)
 
-def generate_day_markdown(day: date, entries: list[dict]) -> str:
-    """Generate markdown content for a day's history."""
-    day_name = day.strftime("%A, %B %d, %Y")
-    lines = [f"# Browser History: {day_name}", ""]
+        title = escape_markdown(entry.title) or "Untitled"
+        visit_lines += f"- {entry.time} - [{title}]({entry.url})\n".encode("utf-8")
 
-    # Sort by timestamp and dedupe (keeps first visit to each URL)
-    sorted_entries = sorted(entries, key=lambda e: e["timestamp"])
-    deduped_entries = dedupe_entries(sorted_entries)
+    # Counter's update loop runs in C
+    domain_counts = Counter(map(attrgetter("domain"), visits))
 
     # Add domain summary
-    domain_counts = count_domains(deduped_entries)
     if domain_counts:
-        domain_strs = [f"{domain} ({count})" for domain, count in domain_counts[:10]]
+        # Partial selection of the top 10 instead of sorting every domain
+        top_domains = heapq.nsmallest(10, domain_counts.items(), key=lambda x: (-x[1], x[0]))
+        domain_strs = [f"{domain} ({count})" for domain, count in top_domains]
         if len(domain_counts) > 10:
             domain_strs.append(f"... and {len(domain_counts) - 10} more")
         lines.append(f"**Domains:** {', '.join(domain_strs)}")
@@ -426,24 +654,187 @@ def generate_day_markdown(day: date, entries: list[dict]) -> str:
     # Add visit entries
     lines.append("## Visits")
     lines.append("")
-    for entry in deduped_entries:
-        time_str = entry["timestamp"].strftime("%H:%M")
-        title = entry["title"] or "Untitled"
-        url = entry["url"]
-        lines.append(f"- {time_str} - [{title}]({url})")
+    header = "\n".join(lines) + "\n"
+    # Prepend in place rather than concatenating, so the visit lines (nearly
+    # all of the digest) are never held twice
+    visit_lines[:0] = header.encode("utf-8")
+    return visit_lines
 
-    lines.append("")
-    return "\n".join(lines)
 
+def write_day_file(day: date, entries: list[Entry]) -> None:
+    """Write a daily digest markdown file.
 
-def write_day_file(day: date, entries: list[dict]) -> None:
-    """Write a daily digest markdown file."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+    The digest is written to a temp file and renamed into place, so an
+    interrupted run never leaves a truncated file behind. The temp file name
+    includes the process ID so overlapping runs never share it. A file whose
+    content would not change is left untouched.
+    """
     filename = OUTPUT_DIR / f"{day.isoformat()}.md"
-    content = generate_day_markdown(day, entries)
+    tmp_filename = OUTPUT_DIR / f".{filename.name}.{os.getpid()}.tmp"
+    data = generate_day_markdown(day, entries)
+
+    # Compare sizes first so changed files are rarely read back
+    try:
+        if filename.stat().st_size == len(data) and filename.read_bytes() == data:
+            return
+    except FileNotFoundError:
+        pass
+
+    tmp_filename.write_bytes(data)
+    os.replace(tmp_filename, filename)
+
+
+def get_written_days() -> set[date]:
+    """Get set of days whose digest files have been written."""
+    try:
+        return {date.fromisoformat(d) for d in json.loads(WRITTEN_DAYS_FILE.read_text())}
+    except Exception:
+        pass
+
+    # Seed from digests written before the manifest existed
+    written_days = set()
+    for path in OUTPUT_DIR.glob("????-??-??.md"):
+        try:
+            written_days.add(date.fromisoformat(path.stem))
+        except ValueError:
+            continue
+    return written_days
+
+
+def set_written_days(written_days: set[date]) -> None:
+    """Record the days whose digest files have been written."""
+    WRITTEN_DAYS_FILE.write_text(json.dumps(sorted(d.isoformat() for d in written_days)))
+
+
+def open_index_db() -> sqlite3.Connection:
+    """Open the index of visits read for the current day, creating it if needed.
+
+    An unreadable index is deleted and rebuilt rather than failing every run.
+    A rebuilt index records no filled sources, so today is read again in full.
+    """
+    try:
+        return connect_index_db()
+    except sqlite3.OperationalError:
+        raise  # Locked by an overlapping run, not damaged
+    except sqlite3.DatabaseError as e:
+        log_error(f"Rebuilding unreadable visit index: {e}")
+
+    for path in (INDEX_DB, Path(f"{INDEX_DB}-wal"), Path(f"{INDEX_DB}-shm")):
+        path.unlink(missing_ok=True)
+    return connect_index_db()
+
+
+def connect_index_db() -> sqlite3.Connection:
+    """Connect to the visit index, creating its tables if needed.
+
+    The visits table holds the day's visits. The filled_sources table lists
+    the sources whose visits since the start of the day are all in the index.
+    """
+    # Transactions are managed explicitly. Write-ahead logging with
+    # synchronous=NORMAL syncs to disk at checkpoints rather than every commit.
+    conn = sqlite3.connect(INDEX_DB, isolation_level=None)
+    try:
+        conn.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+        """)
+        # The index only holds a day of visits, so checking it is cheap
+        problem = conn.execute("PRAGMA quick_check").fetchone()[0]
+        if problem != "ok":
+            raise sqlite3.DatabaseError(problem)
+
+        conn.executescript("""
+            BEGIN IMMEDIATE;
+            CREATE TABLE IF NOT EXISTS visits (
+                profile TEXT NOT NULL,
+                timestamp REAL NOT NULL,
+                url TEXT NOT NULL,
+                title TEXT NOT NULL,
+                PRIMARY KEY (profile, timestamp, url)
+            );
+            CREATE TABLE IF NOT EXISTS filled_sources (
+                source TEXT PRIMARY KEY,
+                day_start REAL NOT NULL
+            );
+            COMMIT;
+        """)
+    except Exception:
+        conn.close()
+        raise
+    return conn
+
+
+def get_filled_sources(conn: sqlite3.Connection, day: date) -> set[str]:
+    """Get the sources whose visits since the start of day are all indexed."""
+    day_start = datetime.combine(day, datetime.min.time()).timestamp()
+    rows = conn.execute("SELECT source FROM filled_sources WHERE day_start = ?", (day_start,))
+    return {source for (source,) in rows}
+
+
+def set_filled_sources(conn: sqlite3.Connection, day: date, sources: list[str]) -> None:
+    """Record sources whose visits since the start of day are all indexed.
+
+    Only call this once their entries have been added with update_index.
+    """
+    day_start = datetime.combine(day, datetime.min.time()).timestamp()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM filled_sources WHERE day_start != ?", (day_start,))
+        conn.executemany(
+            "INSERT OR REPLACE INTO filled_sources (source, day_start) VALUES (?, ?)",
+            [(source, day_start) for source in sources],
+        )
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
 
-    with open(filename, "w") as f:
-        f.write(content)
+
+def update_index(conn: sqlite3.Connection, day: date, entries: list[Entry]) -> list[Entry]:
+    """Add newly read entries for a day to the index, dropping earlier days.
+
+    Visits that were read before are updated with their current title. Days
+    are bounded by Unix timestamps rather than stored, so they follow the
+    current time zone.
+
+    Returns:
+        All indexed entries for the day, in timestamp order
+    """
+    day_start = datetime.combine(day, datetime.min.time()).timestamp()
+    day_end = datetime.combine(day + timedelta(days=1), datetime.min.time()).timestamp()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("DELETE FROM visits WHERE timestamp < ?", (day_start,))
+        conn.executemany(
+            """
+            INSERT INTO visits (profile, timestamp, url, title)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT (profile, timestamp, url) DO UPDATE SET title = excluded.title
+            """,
+            [(entry.profile, entry.timestamp, entry.url, entry.title) for entry in entries],
+        )
+        rows = conn.execute(
+            "SELECT profile, timestamp, url, title FROM visits WHERE timestamp < ? ORDER BY timestamp",
+            (day_end,),
+        ).fetchall()
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+
+    indexed = []
+    for profile, timestamp, url, title in rows:
+        _, time_str = local_day_and_time(timestamp)
+        indexed.append(Entry(
+            url=url,
+            title=title,
+            timestamp=timestamp,
+            day=day,
+            time=time_str,
+            profile=profile,
+            domain=sys.intern(get_domain(url)),
+        ))
+    return indexed
 
 
 def get_state_file() -> Path:
@@ -451,48 +842,80 @@ def get_state_file() -> Path:
     return OUTPUT_DIR / ".last_run"
 
 
-def get_last_run() -> datetime | None:
-    """Get timestamp of last successful run."""
+def get_last_visit_ids() -> dict[str, int]:
+    """Get the newest visit row id read from each source on previous runs."""
     state_file = get_state_file()
     if not state_file.exists():
-        return None
+        return {}
     try:
-        timestamp = float(state_file.read_text().strip())
-        return datetime.fromtimestamp(timestamp)
+        state = json.loads(state_file.read_text())
     except Exception:
-        return None
+        return {}
+    # Older versions stored a bare run timestamp or per-source visit times;
+    # treat as a first run
+    if not isinstance(state, dict) or not isinstance(state.get("last_visit_ids"), dict):
+        return {}
+    return state["last_visit_ids"]
 
 
-def set_last_run(dt: datetime) -> None:
-    """Record timestamp of this run."""
-    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+def set_last_visit_ids(last_visit_ids: dict[str, int]) -> None:
+    """Record the newest visit row id read from each source."""
     state_file = get_state_file()
-    state_file.write_text(str(dt.timestamp()))
+    state_file.write_text(json.dumps({"last_visit_ids": last_visit_ids}, indent=2))
 
 
 def main() -> None:
     """Main entry point."""
-    # Determine start date
-    last_run = get_last_run()
+    OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Resume each source after the newest visit read from it last time.
+    # Sources whose visits from earlier today are all in the index only read
+    # recent visits again; others (after a failed read, a new day or a new
+    # index) read all of today again.
+    # Sources without a recorded visit are backfilled from all available history.
+    last_visit_ids = get_last_visit_ids()
+    index = open_index_db()
     today = datetime.now().date()
-    if last_run:
-        # Get entries since last run, but regenerate full current day
-        day_start = datetime.combine(today, datetime.min.time())
-        since = min(last_run - timedelta(hours=1), day_start)
-    else:
-        # First run: backfill all available history
-        since = None
+    filled_sources = get_filled_sources(index, today)
+    start_of_today = datetime.combine(today, datetime.min.time()) - timedelta(microseconds=1)
+    recent = datetime.now() - RECENT_VISIT_LOOKBACK
 
-    all_entries = []
+    source_entries = []
+    read_sources = []
     sources_status = {}
     permission_errors = []
     notified_errors = get_notified_errors()
 
-    # Collect from Chrome profiles
+    # Read Chrome profiles and Safari in parallel; the work is file I/O and
+    # SQLite calls, which release the GIL
     chrome_profiles = get_chrome_profiles()
-    for profile in chrome_profiles:
-        entries, error = read_history_from_profile(profile, since)
-        source_name = f"Chrome/{profile.name}"
+    chrome_running = is_process_running(CHROME_PROCESS_PATTERN)
+    safari_running = is_process_running(SAFARI_PROCESS_PATTERN)
+    chrome_futures = {}
+    with ThreadPoolExecutor(max_workers=min(8, len(chrome_profiles) + 1)) as pool:
+        for profile in chrome_profiles:
+            source_name = f"Chrome/{profile.name}"
+            reread_after = recent if source_name in filled_sources else start_of_today
+            chrome_futures[source_name] = pool.submit(
+                read_history_from_profile,
+                profile,
+                last_visit_ids.get(source_name),
+                datetime_to_webkit(reread_after),
+                chrome_running,
+            )
+
+        reread_after = recent if "Safari" in filled_sources else start_of_today
+        safari_future = pool.submit(
+            read_safari_history,
+            last_visit_ids.get("Safari"),
+            datetime_to_mac_absolute(reread_after),
+            safari_running,
+        )
+
+    # Collect from Chrome profiles. Entries are only kept from sources read
+    # successfully, since a read that failed part way may be incomplete.
+    for source_name, future in chrome_futures.items():
+        entries, last_visit_id, error = future.result()
 
         if error:
             sources_status[source_name] = {"status": "error", "error": error}
@@ -500,13 +923,15 @@ def main() -> None:
                 permission_errors.append(f"{source_name}: {error}")
         else:
             sources_status[source_name] = {"status": "ok", "entries": len(entries)}
+            if last_visit_id is not None:
+                last_visit_ids[source_name] = last_visit_id
             # Clear any previous notification for this source
-            clear_notified_error(source_name)
-
-        all_entries.extend(entries)
+            notified_errors.discard(source_name)
+            source_entries.append(entries)
+            read_sources.append(source_name)
 
     # Collect from Safari
-    safari_entries, safari_error = read_safari_history(since)
+    safari_entries, safari_last_visit_id, safari_error = safari_future.result()
 
     if safari_error:
         sources_status["Safari"] = {"status": "error", "error": safari_error}
@@ -514,9 +939,11 @@ def main() -> None:
             permission_errors.append(f"Safari: {safari_error}")
     else:
         sources_status["Safari"] = {"status": "ok", "entries": len(safari_entries)}
-        clear_notified_error("Safari")
-
-    all_entries.extend(safari_entries)
+        if safari_last_visit_id is not None:
+            last_visit_ids["Safari"] = safari_last_visit_id
+        notified_errors.discard("Safari")
+        source_entries.append(safari_entries)
+        read_sources.append("Safari")
 
     # Handle permission errors - notify once, create visible indicator
     if permission_errors:
@@ -530,36 +957,48 @@ def main() -> None:
                     "Memex Browser Capture",
                     f"{source} access blocked - grant Full Disk Access to Python"
                 )
-                add_notified_error(source)
+                notified_errors.add(source)
     else:
         # All good - remove error indicator if it exists
         remove_error_indicator()
 
+    set_notified_errors(notified_errors)
+
     # Write status file
     write_status({
         "sources": sources_status,
         "has_errors": bool(permission_errors)
     })
 
-    if not all_entries:
+    if not any(source_entries):
         if not chrome_profiles and not SAFARI_HISTORY.exists():
             log_error("No Chrome profiles or Safari history found")
-        set_last_run(datetime.now())
+        set_filled_sources(index, today, read_sources)
+        index.close()
+        set_last_visit_ids(last_visit_ids)
         return
 
-    # Group by day and write files
-    days = group_entries_by_day(all_entries)
-
-    for day_date, entries in days.items():
-        # For historical days, only write if file doesn't exist
-        # For current day, always regenerate
-        is_today = (day_date == today)
-        filename = OUTPUT_DIR / f"{day_date.isoformat()}.md"
-
-        if is_today or not filename.exists():
-            write_day_file(day_date, entries)
-
-    set_last_run(datetime.now())
+    # Each source is read in timestamp order, so merging them yields entries
+    # day by day and each day's file is written as soon as it is complete.
+    # For historical days, only write if not written before
+    # For current day, regenerate from the index of all visits read today
+    written_days = get_written_days()
+    merged_entries = heapq.merge(*source_entries, key=attrgetter("timestamp"))
+    for day_date, day_entries in groupby(merged_entries, key=attrgetter("day")):
+        if day_date != today and day_date in written_days:
+            continue
+        day_entries = list(day_entries)
+        if day_date == today:
+            day_entries = update_index(index, today, day_entries)
+        write_day_file(day_date, day_entries)
+        written_days.add(day_date)
+
+    # Only now are the sources read this run fully indexed for today
+    set_filled_sources(index, today, read_sources)
+    index.close()
+
+    set_written_days(written_days)
+    set_last_visit_ids(last_visit_ids)
 
 
 if __name__ == "__main__":